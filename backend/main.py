@@ -1,17 +1,28 @@
-import time
-from fastapi import FastAPI, UploadFile, File, HTTPException, Header, Response
+import asyncio
+from fastapi import FastAPI, UploadFile, File, HTTPException, Header, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 from typing import List, Optional
 import uvicorn
-import json
+import anyio
+import hashlib
+import orjson
+import re
 import uuid
-import traceback
+import logging
+import tempfile
 import os
 
+import numpy as np
+
 from utils.pdf_processor import extract_text_from_pdf, chunk_text
-from utils.gemini_client import get_gemini_response, get_structured_response
-from utils.vector_store import vector_store
+from utils.context_builder import build_context
+from utils.gemini_client import aget_gemini_response, aget_combined_study_pack, close_client
+from utils.vector_store import vector_store, aembed_query_cached
+from utils.semantic_cache import semantic_cache
+
+logging.basicConfig(level=os.environ.get("LOG_LEVEL", "INFO").upper())
+logger = logging.getLogger(__name__)
 
 app = FastAPI(title="ScholarSync API")
 
@@ -27,6 +38,16 @@ async def root_head():
 async def health():
     return {"status": "ok"}
 
+
+@app.on_event("startup")
+async def raise_threadpool_limit():
+    # Allow many blocking Gemini/vector calls to run concurrently off the loop
+    anyio.to_thread.current_default_thread_limiter().total_tokens = 64
+
+@app.on_event("shutdown")
+async def close_gemini_client():
+    close_client()
+
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
@@ -37,26 +58,118 @@ app.add_middleware(
 
 # ================= UTIL =================
 
+# Strips a leading ```/```json fence and a trailing ``` in one pass,
+# compiled once at import instead of per response.
+_FENCE_RE = re.compile(r"\A\s*```(?:json)?\s*|\s*```\s*\Z")
+
 def clean_json_string(raw: str) -> str:
     """Extracts JSON from a string, handling markdown and extra text."""
-    raw = raw.strip()
+    raw = _FENCE_RE.sub("", raw).strip()
+    # Find boundaries of the JSON object or list
+    start = min((i for i in (raw.find("{"), raw.find("[")) if i >= 0), default=-1)
+    if start == -1:
+        return raw # Fallback
+    end = max(raw.rfind("}"), raw.rfind("]"))
+    if end <= start:
+        return raw # Fallback
+    return raw[start:end + 1]
+
+# Materials lists cached per session + version, so the analysis and query
+# endpoints don't rescan the whole Chroma collection on every request.
+_materials_cache: dict = {}
+
+def _get_materials_cached(session_id: str) -> list[dict]:
+    """Returns the session's materials list, scanning Chroma only after the
+    document set has changed (version bumped on upload/delete/clear)."""
+    key = f"{session_id}:{_session_ver.get(session_id, 0)}"
+    cached = _materials_cache.get(key)
+    if cached is None:
+        for stale in [k for k in _materials_cache if k.startswith(f"{session_id}:")]:
+            del _materials_cache[stale]
+        cached = vector_store.get_all_materials(session_id)
+        _materials_cache[key] = cached
+    return cached
+
+def _doc_set_hash(session_id: str) -> str:
+    """Hashes the session's current set of filenames, for cache keys that
+    must invalidate whenever uploads change."""
+    names = sorted({m["filename"] for m in _get_materials_cached(session_id)})
+    return hashlib.sha256("|".join(names).encode()).hexdigest()[:16]
+
+def _session_etag(session_id: str) -> str:
+    """ETag for the study endpoints: changes whenever the document set does.
+
+    blake2b is noticeably faster than SHA-256 for these short digests.
+    """
+    h = hashlib.blake2b(digest_size=16)
+    h.update(str(_session_ver.get(session_id, 0)).encode())
+    for name in sorted({m["filename"] for m in _get_materials_cached(session_id)}):
+        h.update(name.encode())
+    return f'"{h.hexdigest()}"'
+
+
+# Fixed retrieval prompt used to gather context for the combined study pack.
+# Module-level so the embedding cache key is stable across requests.
+_STUDY_PACK_QUERY = "Summary of the main topics, key technical concepts, definitions, and assessment-worthy details across all documents."
+
+# One Gemini round-trip produces every study artifact (analysis, concepts,
+# quiz, flashcards); the four analysis endpoints are projections of this
+# cached pack. Keyed by session + version, bumped on upload/delete/clear.
+_study_pack_cache: dict = {}
+_session_ver: dict = {}
+
+def _bump_session(session_id: str):
+    """Invalidates cached study packs after the document set changes."""
+    _session_ver[session_id] = _session_ver.get(session_id, 0) + 1
+    # The doc-set hash in /query's cache namespace already prevents stale
+    # answers, but the superseded namespaces would otherwise sit in memory
+    # until process restart; drop them with the rest of the session state
+    semantic_cache.clear(f"{session_id}/")
+
+async def _get_study_pack(session_id: str) -> dict:
+    """Returns the combined study pack, computing it once per document set.
+
+    Returns an empty dict when the session has no material.
+    """
+    key = f"{session_id}:{_session_ver.get(session_id, 0)}"
+    pack = _study_pack_cache.get(key)
+    if pack is not None:
+        return pack
+
+    q_emb = np.asarray(await aembed_query_cached(_STUDY_PACK_QUERY), dtype=np.float32)
+    results = await asyncio.to_thread(vector_store.query, session_id, _STUDY_PACK_QUERY, n_results=6, query_embeddings=[q_emb])
+    docs = results.get("documents", [[]])[0]
+    doc_embs = results.get("embeddings")
+    doc_embs = doc_embs[0] if doc_embs is not None else None
+
+    if not docs:
+        return {}
+
+    # Budgeted, deduplicated context instead of a raw join + char truncation
+    full_context = build_context(docs, embeddings=doc_embs)
+
+    await asyncio.sleep(2) # Rate limit protection
+    raw = await aget_combined_study_pack(full_context)
+
     try:
-        # Find boundaries of the JSON object or list
-        indices = [i for i in [raw.find("{"), raw.find("[")] if i != -1]
-        if not indices:
-            return raw # Fallback
-        start = min(indices)
-        end = max(raw.rfind("}"), raw.rfind("]"))
-        if end <= start:
-            return raw # Fallback
-        return raw[start:end + 1]
-    except Exception:
-        return raw
+        data = orjson.loads(clean_json_string(raw))
+        if not isinstance(data, dict):
+            raise ValueError("Expected a JSON object")
+    except ValueError as e:  # orjson.JSONDecodeError is a ValueError
+        logger.error("Study Pack Parse Error: %s", e)
+        raise HTTPException(500, "Failed to generate structured study pack.")
+
+    # Drop stale versions so abandoned sessions don't accumulate
+    for stale in [k for k in _study_pack_cache if k.startswith(f"{session_id}:")]:
+        del _study_pack_cache[stale]
+    _study_pack_cache[key] = data
+    return data
 
 # ================= MODELS =================
 
 class QueryRequest(BaseModel):
     prompt: str
+    no_cache: bool = False
 
 class SourceInfo(BaseModel):
     filename: str
@@ -98,6 +211,32 @@ class StudyResponse(BaseModel):
 # ================= ROUTES =================
 # Root ('/') routes are defined above to avoid duplicates.
 
+# Uploads spool to RAM up to this size, then spill to disk
+_SPOOL_MAX_SIZE = 8 * 1024 * 1024
+_READ_BLOCK = 1024 * 1024
+
+async def _spool_upload(file: UploadFile):
+    """Copies an upload into a spooled temp file in 1 MiB blocks, so the
+    transfer itself never buffers the whole body on the event loop.
+
+    Extraction later reads the spool back as a single bytes object (for
+    content hashing and PyMuPDF), so one file's worth of memory is still
+    paid there - but only once per file, off the loop, not per block.
+    """
+    spool = tempfile.SpooledTemporaryFile(max_size=_SPOOL_MAX_SIZE)
+    await file.seek(0)
+    while True:
+        block = await file.read(_READ_BLOCK)
+        if not block:
+            break
+        spool.write(block)
+    spool.seek(0)
+    return spool
+
+# Indexer flushes to the vector store once this many chunks accumulate,
+# large enough to exploit the embedder's batch path
+_INDEX_FLUSH_CHUNKS = 256
+
 @app.post("/upload")
 async def upload_materials(
     response: Response,
@@ -107,78 +246,137 @@ async def upload_materials(
     session_id = x_session_id or "default_user"
     uploaded_count, errors = 0, []
 
+    pdf_files = []
     for file in files:
-        try:
-            if not file.filename.lower().endswith(".pdf"):
-                errors.append(f"{file.filename}: Not a PDF")
-                continue
-
-            content = await file.read()
-            text = extract_text_from_pdf(content)
-
-            if not text.strip():
-                errors.append(f"{file.filename}: Empty content")
-                continue
-
-            chunks = chunk_text(text)
-            metadatas = [{"filename": file.filename} for _ in chunks]
-            ids = [f"{uuid.uuid4().hex}_{i}" for i in range(len(chunks))]
-            
-            vector_store.add_documents(session_id, chunks, metadatas, ids)
-            uploaded_count += 1
-
-        except Exception as e:
-            errors.append(f"{file.filename}: {str(e)}")
+        if not file.filename.lower().endswith(".pdf"):
+            errors.append(f"{file.filename}: Not a PDF")
+        else:
+            pdf_files.append(file)
+
+    # Three-stage pipeline: extraction of file i+1 overlaps with chunking and
+    # embedding of file i. Bounded queues keep memory flat for big batches.
+    extract_q: asyncio.Queue = asyncio.Queue(maxsize=2)
+    chunk_q: asyncio.Queue = asyncio.Queue(maxsize=2)
+
+    async def extractor():
+        for file in pdf_files:
+            try:
+                spool = await _spool_upload(file)
+                try:
+                    text = await asyncio.to_thread(extract_text_from_pdf, spool)
+                finally:
+                    spool.close()
+                if not text.strip():
+                    errors.append(f"{file.filename}: Empty content")
+                    continue
+                await extract_q.put((file.filename, text))
+            except Exception as e:
+                errors.append(f"{file.filename}: {str(e)}")
+        await extract_q.put(None)
+
+    async def chunker():
+        while True:
+            item = await extract_q.get()
+            if item is None:
+                break
+            filename, text = item
+            try:
+                chunks = await asyncio.to_thread(chunk_text, text)
+                metadatas = [{"filename": filename} for _ in chunks]
+                # One urandom syscall per file; the chunk index keeps IDs
+                # unique within the prefix
+                prefix = uuid.uuid4().hex
+                ids = [f"{prefix}_{i}" for i in range(len(chunks))]
+                await chunk_q.put((filename, chunks, metadatas, ids))
+            except Exception as e:
+                errors.append(f"{filename}: {str(e)}")
+        await chunk_q.put(None)
+
+    async def indexer():
+        nonlocal uploaded_count
+        pending_chunks, pending_metadatas, pending_ids = [], [], []
+        # Filenames riding in the current buffer; a file never spans flushes
+        # because the threshold is checked only after its chunks land whole
+        pending_files = []
+
+        async def flush():
+            nonlocal uploaded_count
+            if not pending_chunks:
+                return
+            try:
+                await asyncio.to_thread(
+                    vector_store.add_documents, session_id,
+                    list(pending_chunks), list(pending_metadatas), list(pending_ids),
+                )
+                uploaded_count += len(pending_files)
+            except Exception as e:
+                # Keep the endpoint's structured error contract: report every
+                # file the failed flush carried instead of escaping as a 500
+                for name in pending_files:
+                    errors.append(f"{name}: {str(e)}")
+            pending_chunks.clear()
+            pending_metadatas.clear()
+            pending_ids.clear()
+            pending_files.clear()
+
+        while True:
+            item = await chunk_q.get()
+            if item is None:
+                break
+            filename, chunks, metadatas, ids = item
+            pending_chunks.extend(chunks)
+            pending_metadatas.extend(metadatas)
+            pending_ids.extend(ids)
+            pending_files.append(filename)
+            if len(pending_chunks) >= _INDEX_FLUSH_CHUNKS:
+                await flush()
+        await flush()
+
+    await asyncio.gather(extractor(), chunker(), indexer())
+    if uploaded_count > 0:
+        _bump_session(session_id)
 
     if uploaded_count == 0 and errors:
         raise HTTPException(status_code=400, detail=errors[0])
-    
+
     response.status_code = 201 if uploaded_count > 0 else 200
     return {"message": f"Uploaded {uploaded_count} files", "errors": errors if errors else None}
 
 @app.get("/materials")
 async def list_materials(x_session_id: Optional[str] = Header(None)):
     session_id = x_session_id or "default_user"
-    return vector_store.get_all_materials(session_id)
+    return await asyncio.to_thread(_get_materials_cached, session_id)
 
 @app.delete("/materials")
 async def clear_library(x_session_id: Optional[str] = Header(None)):
     session_id = x_session_id or "default_user"
-    vector_store.clear_all(session_id)
+    await asyncio.to_thread(vector_store.clear_all, session_id)
+    _bump_session(session_id)
     return {"message": "Library cleared"}
 
 @app.delete("/materials/{filename}")
 async def delete_file(filename: str, x_session_id: Optional[str] = Header(None)):
     session_id = x_session_id or "default_user"
-    vector_store.delete_file(session_id, filename)
+    await asyncio.to_thread(vector_store.delete_file, session_id, filename)
+    _bump_session(session_id)
     return {"message": f"Deleted {filename}"}
 
 @app.post("/concepts", response_model=ConceptsResponse)
-async def get_concepts(x_session_id: Optional[str] = Header(None)):
+async def get_concepts(request: Request, response: Response, x_session_id: Optional[str] = Header(None)):
     session_id = x_session_id or "default_user"
-    # REDUCED: n_results to 6 for memory safety
-    results = vector_store.query(session_id, "Key technical concepts and definitions", n_results=6)
-    docs = results.get("documents", [[]])[0]
-    
-    if not docs:
+    etag = await asyncio.to_thread(_session_etag, session_id)
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304)
+    response.headers["ETag"] = etag
+    pack = await _get_study_pack(session_id)
+    if not pack:
         return ConceptsResponse(concepts=[], links=[])
-
-    # TRUNCATE: Limit context to 15,000 chars
-    full_context = "\n\n".join(docs)
-    if len(full_context) > 15000:
-        full_context = full_context[:15000] + "... (truncated)"
-
-    time.sleep(2) # Rate limit protection
-    instruction = "Extract key technical terms. Return JSON with 'concepts' list (term, definition, importance 1-10) and 'links' list (source, target)."
-    raw = get_structured_response(instruction, full_context)
-    
     try:
-        data = json.loads(clean_json_string(raw))
         return ConceptsResponse(
-            concepts=data.get("concepts", []),
-            links=data.get("links", [])
+            concepts=pack.get("concepts", []),
+            links=pack.get("links", [])
         )
-    except:
+    except (ValueError, KeyError):
         return ConceptsResponse(concepts=[], links=[])
 
 @app.post("/query", response_model=QueryResponse)
@@ -187,11 +385,21 @@ async def query_materials(
     x_session_id: Optional[str] = Header(None),
 ):
     session_id = x_session_id or "default_user"
-    results = vector_store.query(session_id, request.prompt, n_results=6)
+    q_emb = np.asarray(await aembed_query_cached(request.prompt), dtype=np.float32)
+
+    cache_ns = f"{session_id}/query/{await asyncio.to_thread(_doc_set_hash, session_id)}"
+    if not request.no_cache:
+        cached = semantic_cache.lookup(cache_ns, q_emb, tau=0.95)
+        if cached is not None:
+            return cached
+
+    results = await asyncio.to_thread(vector_store.query, session_id, request.prompt, n_results=6, query_embeddings=[q_emb])
 
     docs = results.get("documents", [[]])[0]
     metas = results.get("metas", results.get("metadatas", [[]]))[0]
-    
+    doc_embs = results.get("embeddings")
+    doc_embs = doc_embs[0] if doc_embs is not None else None
+
     if not docs:
         return QueryResponse(answer="No relevant content found.", sources=[])
 
@@ -203,115 +411,84 @@ async def query_materials(
             sources.append(SourceInfo(filename=fname, snippet=doc[:200] + "..."))
             seen.add(fname)
 
-    answer = get_gemini_response(request.prompt, "\n\n".join(docs))
-    return QueryResponse(answer=answer, sources=sources)
+    answer = await aget_gemini_response(request.prompt, build_context(docs, embeddings=doc_embs))
+    query_response = QueryResponse(answer=answer, sources=sources)
+    semantic_cache.put(cache_ns, q_emb, request.prompt, query_response)
+    return query_response
 
 @app.post("/analyze", response_model=AnalysisResponse)
-async def analyze(x_session_id: Optional[str] = Header(None)):
+async def analyze(request: Request, response: Response, x_session_id: Optional[str] = Header(None)):
     session_id = x_session_id or "default_user"
-    # OPTIMIZED: n_results is 6
-    results = vector_store.query(session_id, "Provide a comprehensive summary and analysis of the main topics and key findings across all documents.", n_results=6)
-    docs = results.get("documents", [[]])[0]
-
-    if not docs:
+    etag = await asyncio.to_thread(_session_etag, session_id)
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304)
+    response.headers["ETag"] = etag
+    pack = await _get_study_pack(session_id)
+    if not pack:
         raise HTTPException(400, "No material to analyze. Please upload documents first.")
 
-    # TRUNCATE: Limit context to 15,000 chars
-    full_context = "\n\n".join(docs)
-    if len(full_context) > 15000:
-        full_context = full_context[:15000] + "... (truncated for speed)"
-
-    time.sleep(2) # Rate limit protection
-    # Ensure gemini-1.5-flash-latest is used (via get_structured_response)
-    raw = get_structured_response(
-        "Analyze the provided context. Return a JSON object with three fields: 'analysis' (a detailed string), 'learning_path' (a list of 5 progressive steps to master the content), and 'connections' (a list of 3-5 links between different topics).",
-        full_context,
-    )
-
     try:
-        data = json.loads(clean_json_string(raw))
         # minimal validation to ensure response is usable
-        if not isinstance(data, dict) or "analysis" not in data:
+        if "analysis" not in pack:
             raise ValueError("Missing 'analysis'")
-        return AnalysisResponse(**data)
-    except Exception as e:
-        print(f"Analysis Parse Error: {str(e)}")
-        raw2 = get_structured_response(
-            "Analyze the provided context. Return ONLY valid JSON with fields: 'analysis', 'learning_path', 'connections'.",
-            full_context,
+        return AnalysisResponse(
+            analysis=pack.get("analysis", ""),
+            learning_path=pack.get("learning_path", []),
+            connections=pack.get("connections", []),
+        )
+    except (ValueError, KeyError) as e:
+        logger.error("Analysis Parse Error: %s", e)
+        # Fallback to a structured error response instead of crashing
+        return AnalysisResponse(
+            analysis="Failed to generate structured analysis.",
+            learning_path=["Review uploaded documents"],
+            connections=["Main content"],
         )
-        try:
-            data2 = json.loads(clean_json_string(raw2))
-            if not isinstance(data2, dict) or "analysis" not in data2:
-                raise ValueError("Missing 'analysis'")
-            return AnalysisResponse(**data2)
-        except Exception:
-            # Fallback to a structured error response instead of crashing
-            return AnalysisResponse(
-                analysis="Failed to generate structured analysis. Here is the raw response: " + raw[:500],
-                learning_path=["Review uploaded documents"],
-                connections=["Main content"],
-            )
 
 @app.post("/quiz", response_model=QuizResponse)
-async def generate_quiz(x_session_id: Optional[str] = Header(None)):
+async def generate_quiz(request: Request, response: Response, x_session_id: Optional[str] = Header(None)):
     session_id = x_session_id or "default_user"
-    # REDUCED: n_results to 6
-    results = vector_store.query(session_id, "Key technical facts, concepts, and assessment-worthy details.", n_results=6)
-    docs = results.get("documents", [[]])[0]
-    
-    if not docs:
+    etag = await asyncio.to_thread(_session_etag, session_id)
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304)
+    response.headers["ETag"] = etag
+    pack = await _get_study_pack(session_id)
+    if not pack:
         raise HTTPException(400, "No material found. Please upload documents first.")
 
-    # TRUNCATE: Limit context to 15,000 chars
-    full_context = "\n\n".join(docs)
-    if len(full_context) > 15000:
-        full_context = full_context[:15000] + "..."
-
-    time.sleep(2) # Rate limit protection
-    instruction = """Generate a technical quiz based on the context. 
-    Return a JSON object with a 'questions' list. 
-    Each question must have: 'question' (string), 'options' (list of 4 strings), and 'correct_answer' (integer index 0-3).
-    Create 5 challenging questions."""
-    
-    raw = get_structured_response(instruction, full_context)
-    
     try:
-        data = json.loads(clean_json_string(raw))
-        return QuizResponse(questions=data.get("questions", []))
-    except Exception as e:
-        print(f"Quiz Parse Error: {str(e)}")
+        return QuizResponse(questions=pack.get("questions", []))
+    except (ValueError, KeyError) as e:
+        logger.error("Quiz Parse Error: %s", e)
         raise HTTPException(500, "Failed to generate structured quiz.")
 
 @app.post("/study", response_model=StudyResponse)
-async def generate_study_cards(x_session_id: Optional[str] = Header(None)):
+async def generate_study_cards(request: Request, response: Response, x_session_id: Optional[str] = Header(None)):
     session_id = x_session_id or "default_user"
-    # REDUCED: n_results to 6
-    results = vector_store.query(session_id, "Key definitions, technical terms, and core concepts for flashcards.", n_results=6)
-    docs = results.get("documents", [[]])[0]
-    
-    if not docs:
+    etag = await asyncio.to_thread(_session_etag, session_id)
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304)
+    response.headers["ETag"] = etag
+    pack = await _get_study_pack(session_id)
+    if not pack:
         raise HTTPException(400, "No material found. Please upload documents first.")
 
-    full_context = "\n\n".join(docs)
-    if len(full_context) > 15000:
-        full_context = full_context[:15000] + "..."
-
-    time.sleep(2) # Rate limit protection
-    instruction = """Generate 8 technical flashcards for spaced repetition study. 
-    Return a JSON object with a 'flashcards' list. 
-    Each card must have: 'front' (concept/question) and 'back' (concise explanation/answer)."""
-    
-    raw = get_structured_response(instruction, full_context)
-    
     try:
-        data = json.loads(clean_json_string(raw))
-        return StudyResponse(flashcards=data.get("flashcards", []))
-    except Exception as e:
-        print(f"Study Parse Error: {str(e)}")
+        return StudyResponse(flashcards=pack.get("flashcards", []))
+    except (ValueError, KeyError) as e:
+        logger.error("Study Parse Error: %s", e)
         raise HTTPException(500, "Failed to generate structured study cards.")
 
 if __name__ == "__main__":
     # Ensure port is an integer and defaults to 10000
     port = int(os.environ.get("PORT", 10000))
-    uvicorn.run(app, host="0.0.0.0", port=port)
\ No newline at end of file
+    uvicorn.run(
+        app,
+        host="0.0.0.0",
+        port=port,
+        access_log=False,
+        proxy_headers=False,
+        log_level="warning",
+        loop="uvloop",
+        http="httptools",
+    )
\ No newline at end of file
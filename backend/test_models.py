@@ -2,9 +2,8 @@ import os
 from google import genai
 from dotenv import load_dotenv
 
-load_dotenv()
-
 def list_models():
+    load_dotenv()
     api_key = os.getenv("GEMINI_API_KEY")
     if not api_key:
         print("Error: GEMINI_API_KEY not found in .env")
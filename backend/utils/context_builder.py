@@ -0,0 +1,51 @@
+import logging
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Coarse chars-per-token estimate; good enough for budgeting LLM context
+_CHARS_PER_TOKEN = 4
+
+def estimate_tokens(text: str) -> int:
+    """Rough token count for a text, without a tokenizer dependency."""
+    return len(text) // _CHARS_PER_TOKEN
+
+def build_context(docs: list[str], embeddings=None, budget_tokens: int = 6000,
+                  dedupe_threshold: float = 0.92, separator: str = "\n\n") -> str:
+    """Packs retrieved chunks into a token budget for the LLM prompt.
+
+    Chunks are taken greedily in relevance order until the budget is
+    exhausted. When the chunks' embeddings are supplied (reused from the
+    vector store - nothing is re-embedded), a chunk whose cosine similarity
+    to an already-included chunk exceeds dedupe_threshold is skipped, since
+    the overlap window of chunking produces near-duplicate neighbours.
+    """
+    embs = None
+    if embeddings is not None and len(embeddings) == len(docs):
+        embs = [np.asarray(e, dtype=np.float32) for e in embeddings]
+
+    included = []
+    included_embs = []
+    used_tokens = 0
+
+    for i, doc in enumerate(docs):
+        cost = estimate_tokens(doc)
+        if included and used_tokens + cost > budget_tokens:
+            logger.debug("Context budget reached after %d of %d chunks.", len(included), len(docs))
+            break
+
+        if embs is not None:
+            emb = embs[i]
+            norm = np.linalg.norm(emb)
+            if norm > 0 and any(
+                float(emb @ other) / (norm * other_norm) > dedupe_threshold
+                for other, other_norm in included_embs
+            ):
+                logger.debug("Skipping near-duplicate chunk %d.", i)
+                continue
+            included_embs.append((emb, norm if norm > 0 else 1.0))
+
+        included.append(doc)
+        used_tokens += cost
+
+    return separator.join(included)
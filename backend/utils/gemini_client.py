@@ -1,22 +1,67 @@
 from google import genai
 from google.genai import types
+import asyncio
+import hashlib
+import httpx
+import logging
 import os
+import re
+import io
+import sqlite3
+import threading
 import time
+from collections import OrderedDict
 from functools import wraps
+
+import numpy as np
 from dotenv import load_dotenv
 
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
+# Pool and keep connections alive so every Gemini call reuses a warm TLS
+# socket instead of paying a fresh handshake; HTTP/2 lets concurrent calls
+# multiplex over one connection.
+_HTTPX_LIMITS = httpx.Limits(max_connections=64, max_keepalive_connections=32,
+                             keepalive_expiry=30)
+_HTTP_OPTIONS = {
+    # Force stable v1 API version to avoid v1beta model availability issues
+    'api_version': 'v1',
+    'client_args': {'limits': _HTTPX_LIMITS, 'http2': True, 'timeout': 60},
+    'async_client_args': {'limits': _HTTPX_LIMITS, 'http2': True, 'timeout': 60},
+}
+
 # Configure the Gemini API
 API_KEY = os.getenv("GEMINI_API_KEY")
 client = None
 
 if API_KEY:
-    print("✅ SUCCESS: GEMINI_API_KEY detected. Configuring Gemini...")
-    # Force stable v1 API version to avoid v1beta model availability issues
-    client = genai.Client(api_key=API_KEY, http_options={'api_version': 'v1'})
+    logger.info("GEMINI_API_KEY detected. Configuring Gemini...")
+    client = genai.Client(api_key=API_KEY, http_options=_HTTP_OPTIONS)
 else:
-    print("❌ ERROR: GEMINI_API_KEY not found in environment variables!")
+    logger.error("GEMINI_API_KEY not found in environment variables!")
+
+def close_client():
+    """Closes the pooled HTTP connections; wired to FastAPI shutdown."""
+    if client:
+        client.close()
+
+# Rate limits and overloaded models; compiled once instead of a list scan
+# on every exception
+_RETRY_PATTERN = re.compile(r"429|RESOURCE_EXHAUSTED|503|OVERLOADED")
+
+def _retry_after_seconds(exc):
+    """Server-suggested wait from a Retry-After header, if the error carries one."""
+    headers = getattr(getattr(exc, "response", None), "headers", None)
+    if headers:
+        value = headers.get("Retry-After")
+        if value:
+            try:
+                return float(value)
+            except ValueError:
+                pass
+    return None
 
 def retry_with_backoff(retries=3, initial_delay=2):
     def decorator(func):
@@ -30,10 +75,39 @@ def retry_with_backoff(retries=3, initial_delay=2):
                 except Exception as e:
                     last_exception = e
                     error_str = str(e).upper()
-                    # Check for rate limits or overloaded models
-                    if any(err in error_str for err in ["429", "RESOURCE_EXHAUSTED", "503", "OVERLOADED"]) and i < retries - 1:
-                        print(f"Gemini API issue ({error_str[:50]}). Retrying in {delay}s... (Attempt {i+1}/{retries})")
-                        time.sleep(delay)
+                    if _RETRY_PATTERN.search(error_str) and i < retries - 1:
+                        # Prefer the server's hint over blind exponential doubling
+                        wait = _retry_after_seconds(e)
+                        if wait is None:
+                            wait = delay
+                        logger.warning("Gemini API issue (%s). Retrying in %ds... (Attempt %d/%d)", error_str[:50], wait, i + 1, retries)
+                        time.sleep(wait)
+                        delay *= 2
+                        continue
+                    raise e
+            raise last_exception
+        return wrapper
+    return decorator
+
+def retry_with_backoff_async(retries=3, initial_delay=2):
+    """Async twin of retry_with_backoff; sleeps on the event loop."""
+    def decorator(func):
+        @wraps(func)
+        async def wrapper(*args, **kwargs):
+            delay = initial_delay
+            last_exception = None
+            for i in range(retries):
+                try:
+                    return await func(*args, **kwargs)
+                except Exception as e:
+                    last_exception = e
+                    error_str = str(e).upper()
+                    if _RETRY_PATTERN.search(error_str) and i < retries - 1:
+                        wait = _retry_after_seconds(e)
+                        if wait is None:
+                            wait = delay
+                        logger.warning("Gemini API issue (%s). Retrying in %ds... (Attempt %d/%d)", error_str[:50], wait, i + 1, retries)
+                        await asyncio.sleep(wait)
                         delay *= 2
                         continue
                     raise e
@@ -41,93 +115,399 @@ def retry_with_backoff(retries=3, initial_delay=2):
         return wrapper
     return decorator
 
+# Response cache: exact-match on (kind, prompt, context) with a TTL. The
+# route layer already does embedding-similarity matching per session (see
+# utils/semantic_cache.py); this is the in-process safety net underneath it,
+# catching verbatim repeats such as the fixed study-pack instruction over
+# unchanged context without another LLM round-trip.
+_RESPONSE_CACHE_MAXSIZE = 256
+_RESPONSE_TTL_SECONDS = 24 * 3600
+_response_cache: OrderedDict = OrderedDict()
+_response_lock = threading.Lock()
+
+def _response_key(kind: str, prompt: str, context: str) -> bytes:
+    return hashlib.sha256(f"{kind}|{prompt}|{context}".encode()).digest()
+
+def _response_cache_get(key: bytes):
+    with _response_lock:
+        entry = _response_cache.get(key)
+        if entry is None:
+            return None
+        created, text = entry
+        if time.time() - created > _RESPONSE_TTL_SECONDS:
+            del _response_cache[key]
+            return None
+        _response_cache.move_to_end(key)
+        return text
+
+def _response_cache_put(key: bytes, text: str):
+    with _response_lock:
+        _response_cache[key] = (time.time(), text)
+        _response_cache.move_to_end(key)
+        while len(_response_cache) > _RESPONSE_CACHE_MAXSIZE:
+            _response_cache.popitem(last=False)
+
+# Instruction strings and config objects are immutable, so build them once
+# at import instead of on every call
+_SYS_INSTR_TEXT = "You are a professional research assistant. ALWAYS use LaTeX for mathematical formulas ($ for inline, $ for block). If the user asks for numericals, represent them in their original mathematical structure using LaTeX."
+_SYS_INSTR_STRUCTURED = "You are a helpful academic assistant. ALWAYS use LaTeX for mathematical formulas ($ for inline, $ for block). If the user asks for numericals, represent them in their original mathematical structure using LaTeX."
+_CFG_TEXT = types.GenerateContentConfig()
+_CFG_JSON = types.GenerateContentConfig(response_mime_type='application/json')
+
+def _build_text_prompt(prompt: str, context: str) -> str:
+    # Construct single prompt string to avoid turn-based validation errors in new SDK
+    if context:
+        return f"{_SYS_INSTR_TEXT}\n\nContext:\n{context}\n\nQuestion: {prompt}"
+    return f"{_SYS_INSTR_TEXT}\n\nQuestion: {prompt}"
+
 @retry_with_backoff(retries=3, initial_delay=2)
-def get_gemini_response(prompt: str, context: str = "", **kwargs) -> str:
-    """Generates a response from Gemini using the provided context."""
-    print(f"DEBUG: Generating text response for prompt: {prompt[:50]}...")
+def get_gemini_response(prompt: str, context: str = "", file_ref=None, **kwargs) -> str:
+    """Generates a response from Gemini using the provided context.
+
+    When file_ref (an uploaded Files API handle) is given, the document
+    travels by reference instead of being inlined into the prompt.
+    """
+    logger.debug("Generating text response for prompt: %s...", prompt[:50])
     if not client:
         raise Exception("Configuration Error: API Key not found")
-    
-    system_instruction = "You are a professional research assistant. ALWAYS use LaTeX for mathematical formulas ($ for inline, $ for block). If the user asks for numericals, represent them in their original mathematical structure using LaTeX."
-    
-    # Construct single prompt string to avoid turn-based validation errors in new SDK
-    full_prompt = f"{system_instruction}\n\n"
-    if context:
-        full_prompt += f"Context:\n{context}\n\n"
-    
-    full_prompt += f"Question: {prompt}"
-    
+
+    cache_key = _response_key("text", prompt, f"{getattr(file_ref, 'name', '')}|{context}")
+    cached = _response_cache_get(cache_key)
+    if cached is not None:
+        logger.debug("Response cache hit for prompt: %s...", prompt[:50])
+        return cached
+
+    full_prompt = _build_text_prompt(prompt, context)
+
     try:
         response = client.models.generate_content(
             model='gemini-1.5-flash-latest',
-            contents=full_prompt,
-            config=types.GenerateContentConfig()
+            contents=full_prompt if file_ref is None else [file_ref, full_prompt],
+            config=_CFG_TEXT
         )
-        print(f"DEBUG: Successfully received response (length: {len(response.text)})")
+        logger.debug("Successfully received response (length: %d)", len(response.text))
+        _response_cache_put(cache_key, response.text)
         return response.text
     except Exception as e:
-        print(f"DEBUG: API Call Error: {str(e)}")
+        logger.debug("API Call Error: %s", e)
         if "404" in str(e):
-            print("ERROR: Model not found. Please check if gemini-2.0-flash is available.")
+            logger.error("Model not found. Please check if gemini-2.0-flash is available.")
         raise e
 
+@retry_with_backoff_async(retries=3, initial_delay=2)
+async def aget_gemini_response(prompt: str, context: str = "", file_ref=None, **kwargs) -> str:
+    """Async variant of get_gemini_response; runs on the event loop."""
+    logger.debug("Generating text response for prompt: %s...", prompt[:50])
+    if not client:
+        raise Exception("Configuration Error: API Key not found")
+
+    cache_key = _response_key("text", prompt, f"{getattr(file_ref, 'name', '')}|{context}")
+    cached = _response_cache_get(cache_key)
+    if cached is not None:
+        logger.debug("Response cache hit for prompt: %s...", prompt[:50])
+        return cached
+
+    full_prompt = _build_text_prompt(prompt, context)
+
+    try:
+        response = await client.aio.models.generate_content(
+            model='gemini-1.5-flash-latest',
+            contents=full_prompt if file_ref is None else [file_ref, full_prompt],
+            config=_CFG_TEXT
+        )
+        logger.debug("Successfully received response (length: %d)", len(response.text))
+        _response_cache_put(cache_key, response.text)
+        return response.text
+    except Exception as e:
+        logger.debug("API Call Error: %s", e)
+        if "404" in str(e):
+            logger.error("Model not found. Please check if gemini-2.0-flash is available.")
+        raise e
+
+def _build_structured_prompt(prompt: str, context: str) -> str:
+    return f"{_SYS_INSTR_STRUCTURED}\n\nContext:\n{context}\n\nInstruction: {prompt}" if context else f"{_SYS_INSTR_STRUCTURED}\n\nInstruction: {prompt}"
+
 @retry_with_backoff(retries=3, initial_delay=2)
 def get_structured_response(prompt: str, context: str = "") -> str:
     """Generates a response from Gemini that is expected to be structured (like JSON)."""
-    print(f"DEBUG: Generating structured response for prompt: {prompt[:50]}...")
+    logger.debug("Generating structured response for prompt: %s...", prompt[:50])
     if not client:
         raise Exception("Configuration Error: API Key not found")
-    
-    system_instruction = "You are a helpful academic assistant. ALWAYS use LaTeX for mathematical formulas ($ for inline, $ for block). If the user asks for numericals, represent them in their original mathematical structure using LaTeX."
-    
-    full_prompt = f"{system_instruction}\n\nContext:\n{context}\n\nInstruction: {prompt}" if context else f"{system_instruction}\n\nInstruction: {prompt}"
-    
+
+    cache_key = _response_key("structured", prompt, context)
+    cached = _response_cache_get(cache_key)
+    if cached is not None:
+        logger.debug("Response cache hit for prompt: %s...", prompt[:50])
+        return cached
+
+    full_prompt = _build_structured_prompt(prompt, context)
+
     try:
         response = client.models.generate_content(
             model='gemini-1.5-flash-latest',
             contents=full_prompt,
-            config=types.GenerateContentConfig(
-                response_mime_type='application/json'
-            )
+            config=_CFG_JSON
         )
-        print(f"DEBUG: Successfully received structured response (length: {len(response.text)})")
+        logger.debug("Successfully received structured response (length: %d)", len(response.text))
+        _response_cache_put(cache_key, response.text)
         return response.text
     except Exception as e:
-        print(f"DEBUG: Structured API Call Error: {str(e)}")
+        logger.debug("Structured API Call Error: %s", e)
         json_only_prompt = full_prompt + "\n\nReturn ONLY valid JSON. No markdown. No commentary."
         response = client.models.generate_content(
             model='gemini-1.5-flash-latest',
             contents=json_only_prompt,
-            config=types.GenerateContentConfig()
+            config=_CFG_TEXT
+        )
+        return response.text
+
+@retry_with_backoff_async(retries=3, initial_delay=2)
+async def aget_structured_response(prompt: str, context: str = "") -> str:
+    """Async variant of get_structured_response; runs on the event loop."""
+    logger.debug("Generating structured response for prompt: %s...", prompt[:50])
+    if not client:
+        raise Exception("Configuration Error: API Key not found")
+
+    cache_key = _response_key("structured", prompt, context)
+    cached = _response_cache_get(cache_key)
+    if cached is not None:
+        logger.debug("Response cache hit for prompt: %s...", prompt[:50])
+        return cached
+
+    full_prompt = _build_structured_prompt(prompt, context)
+
+    try:
+        response = await client.aio.models.generate_content(
+            model='gemini-1.5-flash-latest',
+            contents=full_prompt,
+            config=_CFG_JSON
+        )
+        logger.debug("Successfully received structured response (length: %d)", len(response.text))
+        _response_cache_put(cache_key, response.text)
+        return response.text
+    except Exception as e:
+        logger.debug("Structured API Call Error: %s", e)
+        json_only_prompt = full_prompt + "\n\nReturn ONLY valid JSON. No markdown. No commentary."
+        response = await client.aio.models.generate_content(
+            model='gemini-1.5-flash-latest',
+            contents=json_only_prompt,
+            config=_CFG_TEXT
         )
         return response.text
 
+def _study_pack_instruction(question_count: int, flashcard_count: int) -> str:
+    return f"""Study the provided context and return ONE JSON object with ALL of these fields:
+    - 'analysis': a detailed summary string of the main topics and key findings.
+    - 'learning_path': a list of 5 progressive steps to master the content.
+    - 'connections': a list of 3-5 links between different topics.
+    - 'concepts': a list of key technical terms, each with 'term', 'definition', and 'importance' (1-10).
+    - 'links': a list of concept relationships, each with 'source' and 'target'.
+    - 'questions': a list of {question_count} challenging quiz questions, each with 'question' (string), 'options' (list of 4 strings), and 'correct_answer' (integer index 0-3).
+    - 'flashcards': a list of {flashcard_count} flashcards for spaced repetition, each with 'front' (concept/question) and 'back' (concise explanation/answer)."""
+
+def get_combined_study_pack(context: str, question_count: int = 5, flashcard_count: int = 8) -> str:
+    """Generates every study artifact in a single round-trip.
+
+    Returns raw JSON text with top-level keys: 'analysis', 'learning_path',
+    'connections', 'concepts', 'links', 'questions', 'flashcards'. One call
+    replaces the four separate requests the analyze/concepts/quiz/study
+    endpoints used to make.
+    """
+    return get_structured_response(_study_pack_instruction(question_count, flashcard_count), context)
+
+async def aget_combined_study_pack(context: str, question_count: int = 5, flashcard_count: int = 8) -> str:
+    """Async variant of get_combined_study_pack."""
+    return await aget_structured_response(_study_pack_instruction(question_count, flashcard_count), context)
+
 @retry_with_backoff(retries=3, initial_delay=2)
 def upload_to_gemini(file_bytes: bytes, filename: str):
     """Uploads a file to Gemini Files API for large payload processing."""
     if not client:
         raise Exception("Configuration Error: API Key not found")
-    
-    import tempfile
-    with tempfile.NamedTemporaryFile(delete=False, suffix=".pdf") as tmp:
-        tmp.write(file_bytes)
-        tmp_path = tmp.name
-        
-    try:
-        uploaded_file = client.files.upload_file(path=tmp_path, display_name=filename)
-        return uploaded_file
-    finally:
-        if os.path.exists(tmp_path):
-            os.remove(tmp_path)
+
+    # Stream straight from memory; no temp file round-trip through disk
+    return client.files.upload(
+        file=io.BytesIO(file_bytes),
+        config={'display_name': filename, 'mime_type': 'application/pdf'}
+    )
+
+# Cached Files API handles keyed by content hash: asking several questions
+# about the same document uploads it once and reuses the handle.
+_file_handle_cache: dict = {}
+
+def upload_to_gemini_cached(file_bytes: bytes, filename: str):
+    """Uploads a file once per content hash, reusing the Files API handle."""
+    key = hashlib.sha256(file_bytes).digest()
+    handle = _file_handle_cache.get(key)
+    if handle is None:
+        handle = upload_to_gemini(file_bytes, filename)
+        _file_handle_cache[key] = handle
+    return handle
+
+EMBEDDING_MODEL = 'text-embedding-004'
+
+# Exact-match embedding cache: sqlite for persistence across restarts,
+# fronted by an in-process LRU dict for hot keys. Re-uploads and the
+# overlap window of chunk_text hand us the same text repeatedly; a hit
+# skips the Gemini round-trip entirely.
+# Anchored next to the backend package (overridable via env), not the
+# launch directory, so running the server from elsewhere can't scatter
+# cache files around - and gitignored either way
+_EMBED_CACHE_PATH = os.environ.get("EMBEDDING_CACHE_PATH") or os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "embedding_cache.db"
+)
+_MEM_CACHE_MAXSIZE = 4096
+_mem_cache: OrderedDict = OrderedDict()
+_cache_lock = threading.Lock()
+_db = None
+
+def _embedding_key(text: str) -> bytes:
+    # Model string is part of the key so a model change invalidates everything
+    return hashlib.sha256(f"{EMBEDDING_MODEL}|{text}".encode()).digest()
+
+def _get_embedding_db():
+    global _db
+    if _db is None:
+        _db = sqlite3.connect(_EMBED_CACHE_PATH, check_same_thread=False)
+        _db.execute("CREATE TABLE IF NOT EXISTS embeddings (key BLOB PRIMARY KEY, vec BLOB)")
+        _db.commit()
+    return _db
+
+def _cache_get(key: bytes):
+    with _cache_lock:
+        vec = _mem_cache.get(key)
+        if vec is not None:
+            _mem_cache.move_to_end(key)
+            return vec
+        row = _get_embedding_db().execute("SELECT vec FROM embeddings WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        vec = np.frombuffer(row[0], dtype=np.float32).tolist()
+        _mem_cache[key] = vec
+        while len(_mem_cache) > _MEM_CACHE_MAXSIZE:
+            _mem_cache.popitem(last=False)
+        return vec
+
+def _cache_put(pairs: list[tuple[bytes, list[float]]]):
+    with _cache_lock:
+        db = _get_embedding_db()
+        db.executemany(
+            "INSERT OR REPLACE INTO embeddings (key, vec) VALUES (?, ?)",
+            [(key, np.asarray(vec, dtype=np.float32).tobytes()) for key, vec in pairs]
+        )
+        db.commit()
+        for key, vec in pairs:
+            _mem_cache[key] = vec
+        while len(_mem_cache) > _MEM_CACHE_MAXSIZE:
+            _mem_cache.popitem(last=False)
+
+# text-embedding-004 accepts up to 100 contents / 250k tokens per request;
+# shard below both so a request never trips the payload limit
+_EMBED_MAX_CONTENTS = 100
+_EMBED_MAX_TOKENS = 240000
 
 @retry_with_backoff(retries=5, initial_delay=5)
-def get_embeddings(texts: list[str]) -> list[list[float]]:
-    """Generates embeddings for a list of texts using Gemini's embedding model."""
+def _embed_remote_shard(texts: list[str]) -> list[list[float]]:
+    """Embeds one shard of texts via the Gemini API (batchEmbedContents)."""
     if not client:
         raise Exception("Gemini API client not configured.")
-    
+
+    # Passing a list routes through the batch embed endpoint in the SDK
     response = client.models.embed_content(
-        model='text-embedding-004',
+        model=EMBEDDING_MODEL,
         contents=texts
     )
-    return [item.values for item in response.embeddings]
\ No newline at end of file
+    return [item.values for item in response.embeddings]
+
+def _shard_texts(texts: list[str]) -> list[list[str]]:
+    """Splits texts into shards under the per-request content/token limits."""
+    shards = []
+    shard: list[str] = []
+    shard_tokens = 0
+    for text in texts:
+        cost = len(text) // 4  # coarse chars-per-token estimate
+        if shard and (len(shard) >= _EMBED_MAX_CONTENTS or shard_tokens + cost > _EMBED_MAX_TOKENS):
+            shards.append(shard)
+            shard, shard_tokens = [], 0
+        shard.append(text)
+        shard_tokens += cost
+    if shard:
+        shards.append(shard)
+    return shards
+
+def _embed_remote(texts: list[str]) -> list[list[float]]:
+    """Shards texts under the per-request limits; each shard retries on its own."""
+    results = []
+    for shard in _shard_texts(texts):
+        results.extend(_embed_remote_shard(shard))
+    return results
+
+@retry_with_backoff_async(retries=5, initial_delay=5)
+async def _aembed_remote_shard(texts: list[str]) -> list[list[float]]:
+    """Async twin of _embed_remote_shard."""
+    if not client:
+        raise Exception("Gemini API client not configured.")
+
+    response = await client.aio.models.embed_content(
+        model=EMBEDDING_MODEL,
+        contents=texts
+    )
+    return [item.values for item in response.embeddings]
+
+def get_embeddings(texts: list[str]) -> list[list[float]]:
+    """Generates embeddings for a list of texts, reusing cached vectors."""
+    keys = [_embedding_key(t) for t in texts]
+    results: list = [_cache_get(k) for k in keys]
+
+    # Dedupe misses by key so repeated texts cost one API slot
+    miss_keys: dict = {}
+    for i, vec in enumerate(results):
+        if vec is None:
+            miss_keys.setdefault(keys[i], []).append(i)
+    if miss_keys:
+        miss_items = list(miss_keys.items())
+        fresh = _embed_remote([texts[indices[0]] for _, indices in miss_items])
+        _cache_put([(key, vec) for (key, _), vec in zip(miss_items, fresh)])
+        for (_, indices), vec in zip(miss_items, fresh):
+            for i in indices:
+                results[i] = vec
+        logger.debug("Embedded %d unique texts (%d cache hits).", len(miss_items), len(texts) - sum(len(v) for v in miss_keys.values()))
+
+    return results
+
+async def aget_embeddings(texts: list[str]) -> list[list[float]]:
+    """Async variant of get_embeddings; shares the same persistent cache."""
+    keys = [_embedding_key(t) for t in texts]
+    results: list = [_cache_get(k) for k in keys]
+
+    miss_keys: dict = {}
+    for i, vec in enumerate(results):
+        if vec is None:
+            miss_keys.setdefault(keys[i], []).append(i)
+    if miss_keys:
+        miss_items = list(miss_keys.items())
+        fresh: list = []
+        for shard in _shard_texts([texts[indices[0]] for _, indices in miss_items]):
+            fresh.extend(await _aembed_remote_shard(shard))
+        _cache_put([(key, vec) for (key, _), vec in zip(miss_items, fresh)])
+        for (_, indices), vec in zip(miss_items, fresh):
+            for i in indices:
+                results[i] = vec
+        logger.debug("Embedded %d unique texts (%d cache hits).", len(miss_items), len(texts) - sum(len(v) for v in miss_keys.values()))
+
+    return results
+def _prewarm_connection():
+    """Primes the keep-alive pool so the first real request skips the TLS handshake."""
+    try:
+        # Direct API call on purpose: going through get_embeddings could hit
+        # the persistent cache and never open a socket
+        client.models.embed_content(model=EMBEDDING_MODEL, contents=['warmup'])
+        logger.debug("Gemini connection pre-warmed.")
+    except Exception as e:
+        logger.debug("Connection pre-warm failed (non-fatal): %s", e)
+
+# Cold workers pay ~200-400ms handshaking with Gemini on the first user
+# request; warm the pooled connection in the background at import instead.
+# Set GEMINI_PREWARM=0 to skip (e.g. offline development).
+if client and os.getenv("GEMINI_PREWARM", "1") != "0":
+    threading.Thread(target=_prewarm_connection, daemon=True).start()
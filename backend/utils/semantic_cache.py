@@ -0,0 +1,102 @@
+import logging
+import time
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+class SemanticCache:
+    """Caches responses keyed by query embedding, matched by cosine similarity.
+
+    Entries are namespaced (e.g. per session) so users never see each other's
+    answers. Lookups are batched: each namespace keeps its embeddings stacked
+    in a single (N, d) matrix so one matrix-vector product scores every entry.
+    """
+
+    def __init__(self, max_entries: int = 128, ttl_seconds: int = 3600):
+        self.max_entries = max_entries  # per namespace
+        self.ttl_seconds = ttl_seconds
+        self._namespaces: dict[str, dict] = {}
+
+    def _get_namespace(self, namespace: str) -> dict:
+        return self._namespaces.setdefault(namespace, {
+            "matrix": None,      # (N, d) float32
+            "norms": None,       # (N,) float32
+            "prompts": [],
+            "responses": [],
+            "created": [],
+            "last_used": [],
+        })
+
+    def _drop_rows(self, ns: dict, keep: list[int]):
+        """Rebuilds a namespace keeping only the given row indices."""
+        if ns["matrix"] is not None and len(keep) < len(ns["prompts"]):
+            ns["matrix"] = ns["matrix"][keep] if keep else None
+            ns["norms"] = ns["norms"][keep] if keep else None
+            for field in ("prompts", "responses", "created", "last_used"):
+                ns[field] = [ns[field][i] for i in keep]
+
+    def _evict_expired(self, ns: dict):
+        now = time.time()
+        keep = [i for i, t in enumerate(ns["created"]) if now - t < self.ttl_seconds]
+        self._drop_rows(ns, keep)
+
+    def lookup(self, namespace: str, query_embedding: np.ndarray, tau: float = 0.95):
+        """Returns the cached response whose embedding is within tau cosine
+        similarity of the query, or None on a miss."""
+        ns = self._namespaces.get(namespace)
+        if ns is None:
+            return None
+        self._evict_expired(ns)
+        if ns["matrix"] is None:
+            return None
+
+        q = np.asarray(query_embedding, dtype=np.float32)
+        q_norm = np.linalg.norm(q)
+        if q_norm == 0:
+            return None
+        sims = ns["matrix"] @ q / (ns["norms"] * q_norm)
+        best = int(np.argmax(sims))
+        if sims[best] < tau:
+            return None
+        ns["last_used"][best] = time.time()
+        logger.debug("Semantic cache hit (sim=%.3f) for prompt: %s...", sims[best], ns["prompts"][best][:50])
+        return ns["responses"][best]
+
+    def put(self, namespace: str, query_embedding: np.ndarray, prompt: str, response):
+        """Stores a response under the query embedding, evicting the least
+        recently used entry when the namespace is full."""
+        ns = self._get_namespace(namespace)
+        self._evict_expired(ns)
+
+        q = np.asarray(query_embedding, dtype=np.float32)
+        if np.linalg.norm(q) == 0:
+            return
+
+        # Replace an existing entry for the exact same prompt
+        if prompt in ns["prompts"]:
+            self._drop_rows(ns, [i for i, p in enumerate(ns["prompts"]) if p != prompt])
+
+        if len(ns["prompts"]) >= self.max_entries:
+            lru = min(range(len(ns["last_used"])), key=ns["last_used"].__getitem__)
+            self._drop_rows(ns, [i for i in range(len(ns["prompts"])) if i != lru])
+
+        row = q.reshape(1, -1)
+        if ns["matrix"] is None:
+            ns["matrix"] = row
+            ns["norms"] = np.array([np.linalg.norm(q)], dtype=np.float32)
+        else:
+            ns["matrix"] = np.vstack([ns["matrix"], row])
+            ns["norms"] = np.append(ns["norms"], np.float32(np.linalg.norm(q)))
+        now = time.time()
+        ns["prompts"].append(prompt)
+        ns["responses"].append(response)
+        ns["created"].append(now)
+        ns["last_used"].append(now)
+
+    def clear(self, namespace_prefix: str):
+        """Drops every namespace starting with the given prefix."""
+        for key in [k for k in self._namespaces if k.startswith(namespace_prefix)]:
+            del self._namespaces[key]
+
+# Global instance shared by the API routes
+semantic_cache = SemanticCache()